@@ -1,57 +1,200 @@
 """
 Django ORM tag storage backend.
 """
-from typing import Iterator, List, Optional, Set, Tuple
-from django.db.models import Q, Subquery
+from collections import defaultdict
+from functools import reduce
+from itertools import islice
+import operator
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional, Set, Tuple
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Q, QuerySet
 
-from .tagstore_django.models import Entity as EntityModel, Tag as TagModel, Taxonomy as TaxonomyModel
+from .tagstore_django.models import (
+    MAX_CHAR_FIELD_LENGTH,
+    Entity as EntityModel,
+    EntityTag as EntityTagModel,
+    Tag as TagModel,
+    Taxonomy as TaxonomyModel,
+)
 
 from .. import Tagstore
 from ..models import EntityId, Tag, TaxonomyId, Taxonomy, UserId
 
 
+# Number of rows fetched from the database at a time when streaming long result sets
+ITERATOR_CHUNK_SIZE = 2000
+# Maximum number of rows inserted by a single query when bulk creating
+BULK_CREATE_BATCH_SIZE = 1000
+
+
+def _entity_filter(entity_ids: Iterable[EntityId], prefix: str = '') -> Q:
+    """
+    Build a filter that matches EntityModel rows with any of the given entity IDs.
+
+    Use prefix to filter a related model instead, e.g. prefix='entity__' for EntityTagModel.
+
+    The IDs are grouped by entity type so that the filter contains one
+    "external_id IN (...)" clause per type rather than one clause per entity.
+    """
+    external_ids_by_type = defaultdict(set)  # type: Dict[str, Set[str]]
+    for eid in entity_ids:
+        external_ids_by_type[eid.entity_type].add(eid.external_id)
+    if not external_ids_by_type:
+        return Q()
+    return reduce(operator.or_, (
+        Q(**{prefix + 'entity_type': entity_type, prefix + 'external_id__in': external_ids})
+        for entity_type, external_ids in external_ids_by_type.items()
+    ))
+
+
 class DjangoTagstore(Tagstore):
     """
     Django tag storage backend.
     """
 
+    def __init__(self) -> None:
+        super().__init__()
+        # Cache of (taxonomy_uid, tag name) -> tag id. Tags are never renamed, so entries
+        # stay valid for the lifetime of this (usually per-request) instance.
+        self._tag_id_cache = {}  # type: Dict[Tuple[TaxonomyId, str], int]
+        # Cache of (entity_type, external_id) -> database ID of taxonomy owners.
+        self._owner_cache = {}  # type: Dict[Tuple[str, str], int]
+
+    def _get_tag_id(self, taxonomy_uid: TaxonomyId, name: str) -> int:
+        """
+        Get the database ID of the specified tag.
+
+        Raises TagModel.DoesNotExist if there is no such tag.
+        """
+        key = (taxonomy_uid, name)
+        if key not in self._tag_id_cache:
+            tag_id = TagModel.objects.values_list('id', flat=True).get(taxonomy_id=taxonomy_uid, name=name)
+            self._cache_tag_ids({key: tag_id})
+            return tag_id
+        return self._tag_id_cache[key]
+
+    def _cache_tag_ids(self, tag_ids: Dict[Tuple[TaxonomyId, str], int]) -> None:
+        """
+        Add the given entries to the tag ID cache once the current transaction (if any)
+        commits, so the cache never keeps the ID of a tag whose creation was rolled back.
+        """
+        if tag_ids:
+            transaction.on_commit(lambda: self._tag_id_cache.update(tag_ids))
+
     def create_taxonomy(self, name: str, owner_id: Optional[UserId] = None) -> Taxonomy:
         """ Create a new taxonomy with the specified name and owner. """
-        owner_obj = None
+        owner_pk = None
         if owner_id is not None:
-            (owner_obj, _created) = EntityModel.objects.get_or_create(
-                entity_type=owner_id.entity_type,
-                external_id=owner_id.external_id,
-            )
-        obj = TaxonomyModel.objects.create(name=name, owner=owner_obj)
+            key = (owner_id.entity_type, owner_id.external_id)
+            if key not in self._owner_cache:
+                (owner_obj, _created) = EntityModel.objects.get_or_create(
+                    entity_type=owner_id.entity_type,
+                    external_id=owner_id.external_id,
+                )
+                self._owner_cache[key] = owner_obj.id
+            owner_pk = self._owner_cache[key]
+        obj = TaxonomyModel.objects.create(name=name, owner_id=owner_pk)
         return Taxonomy(uid=obj.id, name=name, owner_id=owner_id, tagstore=self)
 
     def get_taxonomy(self, taxonomy_uid: TaxonomyId) -> Optional[Taxonomy]:
         try:
-            tax = TaxonomyModel.objects.get(pk=taxonomy_uid)
+            tax = TaxonomyModel.objects.select_related('owner').get(pk=taxonomy_uid)
         except TaxonomyModel.DoesNotExist:
             return None
         return tax.as_tuple(self)
 
     def _add_tag_to_taxonomy(self, taxonomy_uid: TaxonomyId, name: str, parent_tag: Optional[str] = None) -> str:
-        if parent_tag:
-            # Check the parent tag:
-            try:
-                pt = TagModel.objects.get(taxonomy_id=taxonomy_uid, name=parent_tag)
-            except TagModel.DoesNotExist:
-                raise ValueError("Invalid parent tag.")
-            path = TagModel.make_path(taxonomy_uid, name, pt.path)
-        else:
-            path = TagModel.make_path(taxonomy_uid, name)
-        db_tag, created = TagModel.objects.get_or_create(
-            taxonomy_id=taxonomy_uid,
-            name=name,
-            defaults={'path': path},
-        )
-        if not created:
-            if db_tag.path.lower() != path.lower():
-                raise ValueError("That tag already exists with a different parent tag.")
-        return db_tag.name
+        return self._add_tags_to_taxonomy_bulk(taxonomy_uid, [(name, parent_tag)])[0]
+
+    @transaction.atomic
+    def _add_tags_to_taxonomy_bulk(
+        self,
+        taxonomy_uid: TaxonomyId,
+        tags: List[Tuple[str, Optional[str]]],
+    ) -> List[str]:
+        """
+        Add many tags to the given taxonomy using a single query plus a single insert.
+
+        tags is a list of (name, parent_tag) tuples, where parent_tag is None or the
+        name of a tag that either already exists or appears earlier in the list.
+        As with _add_tag_to_taxonomy(), tag names must already have been validated.
+
+        Returns the 'name' value of each newly created or existing tag, in order.
+        Raises ValueError (without changing anything) for the same reasons as
+        add_tag_to_taxonomy().
+        """
+        # Load any of the tags and parent tags that already exist, keyed case-insensitively:
+        referenced_names = {name for (name, _parent) in tags} | {parent for (_name, parent) in tags if parent}
+        existing = TagModel.objects.filter(taxonomy_id=taxonomy_uid, name__in=referenced_names)
+        known = {}  # type: Dict[str, Tuple[str, str]]
+        tag_ids = {}  # type: Dict[Tuple[TaxonomyId, str], int]
+        for (tag_id, name, path) in existing.values_list('id', 'name', 'path'):
+            known[name.lower()] = (name, path)
+            tag_ids[(taxonomy_uid, name)] = tag_id
+
+        new_tags = []
+        new_tag_positions = []  # Index in final_names of each of new_tags
+        final_names = []
+        for (name, parent_tag) in tags:
+            if parent_tag:
+                # Check the parent tag:
+                try:
+                    (_parent_name, parent_path) = known[parent_tag.lower()]
+                except KeyError:
+                    raise ValueError("Invalid parent tag.")
+                path = TagModel.make_path(taxonomy_uid, name, parent_path)
+            else:
+                path = TagModel.make_path(taxonomy_uid, name)
+            if len(path) > MAX_CHAR_FIELD_LENGTH:
+                raise ValueError("Tag name is too long for its position in the tag hierarchy.")
+            if name.lower() in known:
+                (existing_name, existing_path) = known[name.lower()]
+                if existing_path.lower() != path.lower():
+                    raise ValueError("That tag already exists with a different parent tag.")
+                final_names.append(existing_name)
+            else:
+                known[name.lower()] = (name, path)
+                new_tags.append(TagModel(taxonomy_id=taxonomy_uid, name=name, path=path))
+                new_tag_positions.append(len(final_names))
+                final_names.append(name)
+        try:
+            with transaction.atomic():
+                TagModel.objects.bulk_create(new_tags, batch_size=BULK_CREATE_BATCH_SIZE)
+        except IntegrityError:
+            # Some of these tags were created by another request since we looked them up.
+            # Fall back to creating them one at a time, using the existing tag where there is one.
+            for (position, tag) in zip(new_tag_positions, new_tags):
+                tag.id = None  # Any ID set by the rolled back insert is no longer valid
+                final_names[position] = self._insert_tag_or_get_existing(tag)
+        for tag in new_tags:
+            # Only some databases (e.g. PostgreSQL) return the IDs of bulk inserted rows.
+            if tag.id is not None:
+                tag_ids[(taxonomy_uid, tag.name)] = tag.id
+        self._cache_tag_ids(tag_ids)
+        return final_names
+
+    def _insert_tag_or_get_existing(self, tag: TagModel) -> str:
+        """
+        Insert the given new tag and return its name.
+
+        If a tag with the same name already exists (e.g. it was just created by another
+        request), check that it has the same parent and return its name instead.
+        """
+        try:
+            with transaction.atomic():
+                tag.save(force_insert=True)
+            return tag.name
+        except IntegrityError:
+            # Use a locking read: unlike a plain read, it sees rows committed by other transactions
+            # after this one started, even under MySQL's default REPEATABLE READ isolation level.
+            existing = TagModel.objects.select_for_update().filter(taxonomy_id=tag.taxonomy_id, name=tag.name)
+            row = existing.values_list('name', 'path').first()
+            if row is None:
+                raise  # The error was not caused by an existing tag, e.g. the taxonomy doesn't exist.
+        (existing_name, existing_path) = row
+        if existing_path.lower() != tag.path.lower():
+            raise ValueError("That tag already exists with a different parent tag.")
+        return existing_name
 
     def get_tag_in_taxonomy(self, name: str, taxonomy_uid: TaxonomyId) -> Optional[Tag]:
         """
@@ -60,24 +203,30 @@ class DjangoTagstore(Tagstore):
         Otherwise returns None.
         """
         try:
-            tag_obj = TagModel.objects.get(taxonomy_id=taxonomy_uid, name=name)
-            return Tag(taxonomy_uid=taxonomy_uid, name=tag_obj.name)
+            tag_name = TagModel.objects.values_list('name', flat=True).get(taxonomy_id=taxonomy_uid, name=name)
+            return Tag(taxonomy_uid=taxonomy_uid, name=tag_name)
         except TagModel.DoesNotExist:
             return None
 
     def list_tags_in_taxonomy(self, taxonomy_uid: TaxonomyId) -> Iterator[Tag]:
-        for tag in TagModel.objects.filter(taxonomy_id=taxonomy_uid).order_by('name'):
-            yield Tag(taxonomy_uid=taxonomy_uid, name=tag.name)
+        tags = TagModel.objects.filter(taxonomy_id=taxonomy_uid).order_by('name')
+        for name in tags.values_list('name', flat=True).iterator(chunk_size=ITERATOR_CHUNK_SIZE):
+            yield Tag(taxonomy_uid=taxonomy_uid, name=name)
 
-    def list_tags_in_taxonomy_hierarchically(self, taxonomy_uid: TaxonomyId) -> Iterator[Tuple[Tag, Tag]]:
+    def list_tags_in_taxonomy_hierarchically(self, taxonomy_uid: TaxonomyId) -> Iterator[Tuple[Tag, Optional[Tag]]]:
         """
         Get a list of all tags in the given taxonomy, in hierarchical and alphabetical order.
 
         Returns tuples of (Tag, parent_tag) where parent_tag is the parent tag. This method
         guarantees that parent tags will be returned before their child tags.
         """
-        for tag in TagModel.objects.filter(taxonomy_id=taxonomy_uid).order_by('path'):
-            yield (Tag(taxonomy_uid=taxonomy_uid, name=tag.name), tag.parent_tag_tuple)
+        # Ordering by path guarantees each parent is seen (and stored in by_path) before its children.
+        by_path = {}  # type: Dict[str, Tag]
+        tags = TagModel.objects.filter(taxonomy_id=taxonomy_uid).order_by('path').values_list('name', 'path')
+        for name, path in tags.iterator(chunk_size=ITERATOR_CHUNK_SIZE):
+            tag = Tag(taxonomy_uid=taxonomy_uid, name=name)
+            by_path[path] = tag
+            yield (tag, by_path.get(TagModel.parent_path(path)))
 
     def get_tags_in_taxonomy_hierarchically_as_dict(self, taxonomy_uid: TaxonomyId) -> dict:
         """
@@ -90,61 +239,85 @@ class DjangoTagstore(Tagstore):
         ]}.
         """
         root = {'children': []}  # type: ignore
-        all_nodes = {None: root}
         taxonomy_uid_as_int = int(taxonomy_uid)
-        for tag in TagModel.objects.filter(taxonomy_id=taxonomy_uid_as_int).order_by('path'):
-            node = {'name': tag.name, 'id': tag.id, 'children': []}
-            as_tuple = Tag(taxonomy_uid=taxonomy_uid_as_int, name=tag.name)
-            all_nodes[as_tuple] = node  # type: ignore
-            all_nodes[tag.parent_tag_tuple]['children'].append(node)
+        # Nodes keyed by materialized path; top-level tags have the taxonomy's path prefix as their parent path.
+        all_nodes = {str(taxonomy_uid_as_int) + TagModel.PATH_SEP: root}
+        tags = TagModel.objects.filter(taxonomy_id=taxonomy_uid_as_int).order_by('path')
+        for (tag_id, name, path) in tags.values_list('id', 'name', 'path'):
+            node = {'name': name, 'id': tag_id, 'children': []}
+            all_nodes[path] = node
+            all_nodes[TagModel.parent_path(path)]['children'].append(node)
         return root
 
     def list_tags_in_taxonomy_containing(self, taxonomy_uid: TaxonomyId, text: str) -> Iterator[Tag]:
-        for tag in TagModel.objects.filter(taxonomy_id=taxonomy_uid, name__icontains=text).order_by('name'):
-            yield Tag(taxonomy_uid=taxonomy_uid, name=tag.name)
+        # On PostgreSQL, name__icontains can use the trigram index added in migration 0004.
+        tags = TagModel.objects.filter(taxonomy_id=taxonomy_uid, name__icontains=text).order_by('name')
+        for name in tags.values_list('name', flat=True).iterator(chunk_size=ITERATOR_CHUNK_SIZE):
+            yield Tag(taxonomy_uid=taxonomy_uid, name=name)
 
     # Tagging Entities ##########################
 
+    @transaction.atomic
     def add_tag_to(self, tag: Tag, *entity_ids: EntityId) -> None:
         """
         Add the specified tag to the specified entity/entities.
 
         Will be a no-op if the tag is already applied.
         """
-        tag_model = TagModel.objects.get(taxonomy_id=tag.taxonomy_uid, name=tag.name)
-        for entity in entity_ids:
-            (em, _created) = EntityModel.objects.get_or_create(
-                entity_type=entity.entity_type,
-                external_id=entity.external_id,
-            )
-            em.tags.add(tag_model)
+        tag_id = self._get_tag_id(tag.taxonomy_uid, tag.name)
+        if not entity_ids:
+            return
+        entities = EntityModel.objects.filter(_entity_filter(entity_ids))
+        # Create any entities that don't exist yet, in a single query:
+        existing = set(entities.values_list('entity_type', 'external_id'))
+        missing = set(entity_ids) - existing
+        if missing:
+            try:
+                with transaction.atomic():
+                    EntityModel.objects.bulk_create(
+                        [EntityModel(entity_type=eid.entity_type, external_id=eid.external_id) for eid in missing],
+                    )
+            except IntegrityError:
+                # Some of these entities already exist, either because they were created concurrently
+                # or because they differ only in case (on case-insensitive databases). Fall back to
+                # creating them one at a time.
+                # From here on, use locking reads: unlike plain reads, they see rows committed by other
+                # transactions after this one started, even under MySQL's default REPEATABLE READ
+                # isolation level.
+                entities = entities.select_for_update()
+                for eid in missing:
+                    try:
+                        with transaction.atomic():
+                            EntityModel.objects.create(entity_type=eid.entity_type, external_id=eid.external_id)
+                    except IntegrityError:
+                        if not entities.filter(entity_type=eid.entity_type, external_id=eid.external_id).exists():
+                            raise
+        # Then apply the tag to all of them, in a single query:
+        EntityTagModel.objects.bulk_create(
+            [EntityTagModel(entity_id=entity_pk, tag_id=tag_id) for entity_pk in entities.values_list('id', flat=True)],
+            ignore_conflicts=True,
+        )
 
+    @transaction.atomic
     def remove_tag_from(self, tag: Tag, *entity_ids: EntityId) -> None:
         """
         Remove the specified tag from the specified entity/entities
 
         Will be a no-op if the entities do not have that tag.
         """
-        tag = TagModel.objects.get(taxonomy_id=tag.taxonomy_uid, name=tag.name)
-        # This could be optimized to a single DB query, but that's probably not necessary
-        for eid in entity_ids:
-            try:
-                EntityModel.objects.get(entity_type=eid.entity_type, external_id=eid.external_id).tags.remove(tag)
-            except EntityModel.DoesNotExist:
-                pass
+        tag_id = self._get_tag_id(tag.taxonomy_uid, tag.name)
+        if not entity_ids:
+            return
+        EntityTagModel.objects.filter(
+            tag_id=tag_id,
+            entity__in=EntityModel.objects.filter(_entity_filter(entity_ids)),
+        ).delete()
 
     def get_tags_applied_to(self, *entity_ids: EntityId) -> Set[Tag]:
         """ Get the set of unique tags applied to any of the specified entity IDs """
-        entity_filter = Q()
-        for eid in entity_ids:
-            q = Q(entity_type=eid.entity_type) & Q(external_id=eid.external_id)
-            entity_filter = entity_filter | q
-        entities = EntityModel.objects.filter(entity_filter)
-        tags = TagModel.objects.filter(entity__id__in=Subquery(entities.values('id')))
-        tags_found = set()
-        for tag in tags:
-            tags_found.add(Tag(taxonomy_uid=tag.taxonomy_id, name=tag.name))
-        return tags_found
+        applied = EntityTagModel.objects.filter(_entity_filter(entity_ids, prefix='entity__'))
+        tags = applied.values_list('tag__taxonomy_id', 'tag__name').distinct()
+        return {Tag(taxonomy_uid=tax_uid, name=name) for tax_uid, name in tags}
 
     # Searching Entities ##########################
 
@@ -157,7 +330,50 @@ class DjangoTagstore(Tagstore):
         include_child_tags=True,  # For hierarchical taxonomies, include child tags
                                   # (e.g. search for "Animal" will return results tagged only with "Dog")
     ) -> Iterator[EntityId]:
+        entities = self._filter_entities_tagged_with_all(
+            tags,
+            entity_types=entity_types,
+            external_id_prefix=external_id_prefix,
+            entity_ids=entity_ids,
+            include_child_tags=include_child_tags,
+        )
+        rows = entities.values_list('entity_type', 'external_id')
+        for (entity_type, external_id) in rows.iterator(chunk_size=ITERATOR_CHUNK_SIZE):
+            yield EntityId(entity_type=entity_type, external_id=external_id)
+
+    def get_entities_with_tags(self, tags: Set[Tag], **kwargs) -> Iterator[Tuple[EntityId, FrozenSet[Tag]]]:
+        """
+        Like get_entities_tagged_with_all(), but also get all the tags applied to each entity.
 
+        The tags are fetched with one query per ITERATOR_CHUNK_SIZE entities.
+        """
+        entities = self._filter_entities_tagged_with_all(tags, **kwargs).values_list('id', 'entity_type', 'external_id')
+        rows = entities.iterator(chunk_size=ITERATOR_CHUNK_SIZE)
+        while True:
+            chunk = list(islice(rows, ITERATOR_CHUNK_SIZE))
+            if not chunk:
+                return
+            tags_by_entity = defaultdict(set)  # type: Dict[int, Set[Tag]]
+            applied = EntityTagModel.objects.filter(entity_id__in=[entity_pk for (entity_pk, _type, _id) in chunk])
+            for (entity_pk, taxonomy_uid, name) in applied.values_list('entity_id', 'tag__taxonomy_id', 'tag__name'):
+                tags_by_entity[entity_pk].add(Tag(taxonomy_uid=taxonomy_uid, name=name))
+            for (entity_pk, entity_type, external_id) in chunk:
+                entity_id = EntityId(entity_type=entity_type, external_id=external_id)
+                yield (entity_id, frozenset(tags_by_entity[entity_pk]))
+
+    def _filter_entities_tagged_with_all(
+        self,
+        tags: Set[Tag],
+        entity_types: Optional[List[str]] = None,
+        external_id_prefix: Optional[str] = None,
+        entity_ids: Optional[List[EntityId]] = None,  # use this to filter a list of entity IDs by tag
+        include_child_tags=True,  # For hierarchical taxonomies, include child tags
+                                  # (e.g. search for "Animal" will return results tagged only with "Dog")
+    ) -> QuerySet:
+        """
+        Get a queryset of the EntityModels that have all the specified tags
+        and match all of the specified conditions
+        """
         if not tags:
             raise ValueError("tags must contain at least one Tag")
 
@@ -165,15 +381,20 @@ class DjangoTagstore(Tagstore):
 
         if include_child_tags:
             # Convert the set of tags to a set of materialized paths:
-            tags_filter = Q()
-            for tag in tags:
-                tags_filter = tags_filter | (Q(taxonomy_id=tag.taxonomy_uid) & Q(name=tag.name))
+            tags_filter = reduce(operator.or_, (Q(taxonomy_id=tag.taxonomy_uid, name=tag.name) for tag in tags))
             paths = TagModel.objects.filter(tags_filter).values_list('path', flat=True)
-            for path in paths:
-                entities = entities.filter(tags__path__startswith=path)
+            tag_conditions = [Q(tags__path__startswith=path) for path in paths]
         else:
-            for tag in tags:
-                entities = entities.filter(tags__taxonomy_id=tag.taxonomy_uid, tags__name=tag.name)
+            tag_conditions = [Q(tags__taxonomy_id=tag.taxonomy_uid, tags__name=tag.name) for tag in tags]
+
+        if tag_conditions:
+            # Join the tags only once, keeping rows that match any of the conditions, then
+            # require (per entity) at least one matching row for every condition.
+            entities = entities.filter(reduce(operator.or_, tag_conditions)).annotate(**{
+                'tag_match_%d' % i: Count('tags', filter=condition) for i, condition in enumerate(tag_conditions)
+            }).filter(**{
+                'tag_match_%d__gt' % i: 0 for i in range(len(tag_conditions))
+            })
 
         if entity_types is not None:
             entities = entities.filter(entity_type__in=entity_types)
@@ -182,10 +403,6 @@ class DjangoTagstore(Tagstore):
             entities = entities.filter(external_id__startswith=external_id_prefix)
 
         if entity_ids is not None:
-            addl_filter = Q()
-            for eid in entity_ids:
-                addl_filter = addl_filter | (Q(entity_type=eid.entity_type) & Q(external_id=eid.external_id))
-            entities = entities.filter(addl_filter)
+            entities = entities.filter(_entity_filter(entity_ids))
 
-        for e in entities:
-            yield EntityId(entity_type=e.entity_type, external_id=e.external_id)
+        return entities
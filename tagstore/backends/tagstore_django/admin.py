@@ -5,7 +5,7 @@ from django.contrib import admin
 
 from tagstore.backends.django import DjangoTagstore
 
-from .models import Taxonomy, Tag, Entity, MAX_CHAR_FIELD_LENGTH
+from .models import Taxonomy, Tag, Entity, EntityTag, MAX_CHAR_FIELD_LENGTH
 
 
 class CustomTagAdminForm(forms.ModelForm):
@@ -49,10 +49,17 @@ class TagAdmin(admin.ModelAdmin):
     #     super(TagAdmin, self).delete_model(request, obj)
 
 
+class EntityTagInline(admin.TabularInline):
+    """ Lists the tags applied to an entity. """
+    model = EntityTag
+    extra = 0
+
+
 class EntityAdmin(admin.ModelAdmin):
     """ Controls display and saving of Entity model objects. """
     list_display = ('entity_type', 'external_id')
     search_fields = ('entity_type', 'external_id')
+    inlines = (EntityTagInline,)
 
 
 admin.site.register(Tag, TagAdmin)
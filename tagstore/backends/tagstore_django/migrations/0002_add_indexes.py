@@ -0,0 +1,17 @@
+# Generated by Django 2.2.16 on 2026-10-15 01:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tagstore_django', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='tag',
+            index=models.Index(fields=['taxonomy', 'path'], name='tagstore_tag_tax_path_idx'),
+        ),
+    ]
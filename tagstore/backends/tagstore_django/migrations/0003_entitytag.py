@@ -0,0 +1,45 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tagstore_django', '0002_add_indexes'),
+    ]
+
+    operations = [
+        # Turn the table that Django created for Entity.tags into an explicit
+        # "through" model. The table already exists with these exact columns
+        # and constraints, so this only changes the migration state.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='EntityTag',
+                    fields=[
+                        ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('entity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='tagstore_django.Entity')),
+                        ('tag', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='tagstore_django.Tag')),
+                    ],
+                    options={
+                        'db_table': 'tagstore_entity_tags',
+                        'unique_together': {('entity', 'tag')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='entity',
+                    name='tags',
+                    field=models.ManyToManyField(through='tagstore_django.EntityTag', to='tagstore_django.Tag'),
+                ),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='entitytag',
+            name='id',
+            field=models.BigAutoField(primary_key=True, serialize=False),
+        ),
+        migrations.AddIndex(
+            model_name='entitytag',
+            index=models.Index(fields=['tag', 'entity'], name='tagstore_entitytag_tag_idx'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+from django.db import migrations
+
+
+def create_trigram_index(apps, schema_editor):
+    """
+    On PostgreSQL, add a trigram index that can serve name__icontains lookups.
+
+    The Tag model's "name" field is stored in the "tag" column, and Django compiles
+    name__icontains on PostgreSQL to UPPER("tag"::text) LIKE UPPER(...), so the index
+    is on that expression. Other databases can't index "contains" searches, so this
+    is a no-op for them.
+
+    Before PostgreSQL 13, CREATE EXTENSION pg_trgm requires a superuser, so unless the
+    extension is already installed, this migration fails for a database user without
+    that privilege. In that case, have an administrator run CREATE EXTENSION pg_trgm
+    in the database first.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(
+        'CREATE INDEX tagstore_tag_tag_trgm_idx ON tagstore_tag USING gin ((UPPER("tag"::text)) gin_trgm_ops)'
+    )
+
+
+def drop_trigram_index(apps, schema_editor):
+    """
+    Remove the index added by create_trigram_index(). The pg_trgm extension is left installed.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS tagstore_tag_tag_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tagstore_django', '0003_entitytag'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
@@ -24,7 +24,7 @@ class Entity(models.Model):
     entity_type = models.CharField(max_length=MAX_CHAR_FIELD_LENGTH)
     external_id = models.CharField(max_length=MAX_CHAR_FIELD_LENGTH)
 
-    tags = models.ManyToManyField('Tag')
+    tags = models.ManyToManyField('Tag', through='EntityTag')
 
     class Meta:
         unique_together = (
@@ -84,9 +84,13 @@ class Tag(models.Model):
         ordering = ('name', )
         unique_together = (
             ('taxonomy', 'name'),
-            # Note that (taxonomy, path) is also unique but we don't bother
-            # with an index for that.
         )
+        indexes = [
+            # (taxonomy, path) is also unique. This index serves hierarchical
+            # listing (ordered by path) and path-prefix searches within a taxonomy.
+            # Lookups by (taxonomy, name) are already served by unique_together.
+            models.Index(fields=['taxonomy', 'path'], name='tagstore_tag_tax_path_idx'),
+        ]
 
     @classmethod
     def make_path(cls, taxonomy_id: int, name: str, parent_path: str = '') -> str:
@@ -103,6 +107,16 @@ class Tag(models.Model):
         else:
             return prefix + name + cls.PATH_SEP
 
+    @classmethod
+    def parent_path(cls, path: str) -> str:
+        """
+        Return the materialized path of the parent of the tag with the given path.
+
+        parent_path('200:animal:mammal:lion:') -> '200:animal:mammal:'
+        parent_path('15:easy:') -> '15:'
+        """
+        return path[:path.rindex(cls.PATH_SEP, 0, -1) + 1]
+
     @property
     def parent_tag_tuple(self) -> Optional[TagTuple]:
         """
@@ -118,3 +132,28 @@ class Tag(models.Model):
 
     def __str__(self) -> str:
         return self.name
+
+
+class EntityTag(models.Model):
+    """
+    A tag applied to an entity (the "through" model of Entity.tags)
+    """
+    id = models.BigAutoField(primary_key=True)
+    entity = models.ForeignKey(Entity, on_delete=models.CASCADE)
+    tag = models.ForeignKey(Tag, on_delete=models.CASCADE)
+
+    class Meta:
+        # This was originally the table of an auto-created ManyToManyField
+        # "through" model, so it keeps that table name.
+        db_table = 'tagstore_entity_tags'
+        unique_together = (
+            # Also serves lookups of the tags applied to an entity
+            ('entity', 'tag'),
+        )
+        indexes = [
+            # Serves searches for the entities that have a given tag
+            models.Index(fields=['tag', 'entity'], name='tagstore_entitytag_tag_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return "%s: %s" % (self.entity, self.tag)
@@ -3,12 +3,14 @@ Tests for all included backends
 """
 # pylint: disable=no-member, too-many-statements
 from typing import Iterable
+from unittest import mock
 
 from django.test import TestCase
 
 from ... import Tagstore
 from ...models import EntityId, Tag, Taxonomy, UserId
 from ..django import DjangoTagstore
+from ..tagstore_django.models import Tag as TagModel
 
 
 # Identify a user that will own the taxonomies we create
@@ -108,6 +110,7 @@ class AbstractBackendTest:
             'foo;bar',
             'new\nline',
             'new\rline',
+            'back\\slash',
         ]
         tax = self.tagstore.create_taxonomy("TestTax", owner_id=some_user)
         for tag in invalid_tags:
@@ -253,6 +256,22 @@ class AbstractBackendTest:
         self.tagstore.add_tag_to(tag, entity_id)
         self.assertEqual(self.tagstore.get_tags_applied_to(entity_id), {tag})
 
+    def test_add_tag_to_many(self):
+        """ Test add_tag_to with several entities, some of which already exist or are tagged """
+        tax = self.tagstore.create_taxonomy("TestTax", owner_id=some_user)
+        tag1 = tax.add_tag('tag1')
+        tag2 = tax.add_tag('tag2')
+        entity1 = EntityId(entity_type='content', external_id='block-v1:b1')
+        entity2 = EntityId(entity_type='content', external_id='block-v1:b2')
+        entity3 = EntityId(entity_type='content', external_id='block-v1:b3')
+
+        self.tagstore.add_tag_to(tag1, entity1)
+        self.tagstore.add_tag_to(tag2, entity1, entity2)
+        self.tagstore.add_tag_to(tag1, entity1, entity2, entity3)
+        self.assertEqual(self.tagstore.get_tags_applied_to(entity1), {tag1, tag2})
+        self.assertEqual(self.tagstore.get_tags_applied_to(entity2), {tag1, tag2})
+        self.assertEqual(self.tagstore.get_tags_applied_to(entity3), {tag1})
+
     def test_remove_tag_from(self):
         """ Test remove_tag_from """
         tax = self.tagstore.create_taxonomy("TestTax", owner_id=some_user)
@@ -376,6 +395,42 @@ class AbstractBackendTest:
         result = set(self.tagstore.get_entities_tagged_with_all({large, mammal}))
         self.assertEqual(result, {elephant})
 
+        # animals that are large, where the dog is also tagged with several kinds of animal:
+        self.tagstore.add_tag_to(mammal, dog)
+        self.tagstore.add_tag_to(fish, dog)
+        result = set(self.tagstore.get_entities_tagged_with_all({large, animal}))
+        self.assertEqual(result, {elephant})
+        result = set(self.tagstore.get_entities_tagged_with_all({mammal, fish}))
+        self.assertEqual(result, {dog})
+
+    def test_get_entities_with_tags(self):
+        """ Test get_entities_with_tags() returns each matching entity with all of its tags """
+        sizes = self.tagstore.create_taxonomy("sizes", owner_id=some_user)
+        small = sizes.add_tag('small')
+        large = sizes.add_tag('large')
+        biology = self.tagstore.create_taxonomy("Biology", owner_id=some_user)
+        animal = biology.add_tag('animal')
+        mammal = biology.add_tag('mammal', parent_tag=animal)
+        plant = biology.add_tag('plant')
+
+        elephant = EntityId(entity_type='thing', external_id='elephant')
+        self.tagstore.add_tag_to(large, elephant)
+        self.tagstore.add_tag_to(mammal, elephant)
+        mouse = EntityId(entity_type='thing', external_id='mouse')
+        self.tagstore.add_tag_to(small, mouse)
+        self.tagstore.add_tag_to(mammal, mouse)
+        redwood = EntityId(entity_type='thing', external_id='redwood')
+        self.tagstore.add_tag_to(large, redwood)
+        self.tagstore.add_tag_to(plant, redwood)
+
+        result = set(self.tagstore.get_entities_with_tags({animal}))
+        self.assertEqual(result, {
+            (elephant, frozenset({large, mammal})),
+            (mouse, frozenset({small, mammal})),
+        })
+        result = set(self.tagstore.get_entities_with_tags({large}, external_id_prefix='r'))
+        self.assertEqual(result, {(redwood, frozenset({large, plant}))})
+
     def test_get_entities_tagged_with_all_invalid(self):
         """ Test get_entities_tagged_with_all() with invalid arguments """
         with self.assertRaises(ValueError):
@@ -388,3 +443,79 @@ class DjangoBackendTest(AbstractBackendTest, TestCase):
 
     def get_tagstore(self) -> Tagstore:
         return DjangoTagstore()
+
+    def test_add_tag_to_taxonomy_too_deep(self):
+        """ add_tag_to_taxonomy will not allow tags whose full path in the hierarchy is too long """
+        tax = self.tagstore.create_taxonomy("TestTax", owner_id=some_user)
+        parent = None
+        with self.assertRaises(ValueError):
+            for i in range(100):
+                parent = tax.add_tag('level {}'.format(i), parent_tag=parent)
+        self.assertGreater(len(list(tax.list_tags())), 1)
+
+    def test_add_tags_to_taxonomy_bulk(self):
+        """ Test adding many tags, including children of tags in the same batch, at once """
+        biology = self.tagstore.create_taxonomy("Biology", owner_id=some_user)
+        plant = biology.add_tag('plant')
+        names = self.tagstore._add_tags_to_taxonomy_bulk(biology.uid, [  # pylint: disable=protected-access
+            ('conifer', 'plant'),
+            ('cypress', 'conifer'),
+            ('pine', 'conifer'),
+            ('plant', None),  # Already exists, so this is a no-op
+            ('aster', 'plant'),
+        ])
+        self.assertEqual(names, ['conifer', 'cypress', 'pine', 'plant', 'aster'])
+        conifer = Tag(taxonomy_uid=biology.uid, name='conifer')
+        self.assertEqual(list(biology.list_tags_hierarchically()), [
+            (plant, None),
+            (Tag(taxonomy_uid=biology.uid, name='aster'), plant),
+            (conifer, plant),
+            (Tag(taxonomy_uid=biology.uid, name='cypress'), conifer),
+            (Tag(taxonomy_uid=biology.uid, name='pine'), conifer),
+        ])
+
+    def test_add_tags_to_taxonomy_bulk_invalid(self):
+        """ Adding tags in bulk changes nothing if any of the tags is invalid """
+        tax = self.tagstore.create_taxonomy("TestTax", owner_id=some_user)
+        tax.add_tag('other')
+        with self.assertRaises(ValueError):
+            self.tagstore._add_tags_to_taxonomy_bulk(tax.uid, [  # pylint: disable=protected-access
+                ('parent', None),
+                ('child', 'nonexistent'),
+            ])
+        with self.assertRaises(ValueError):
+            self.tagstore._add_tags_to_taxonomy_bulk(tax.uid, [  # pylint: disable=protected-access
+                ('parent', None),
+                ('other', 'parent'),
+            ])
+        self.assertEqual([t.name for t in tax.list_tags()], ['other'])
+
+    def _hide_tag_from_lookup(self, name):
+        """
+        Patch the lookup of existing tags so that it misses the given tag, as if the tag
+        had been created by a concurrent request just after the lookup.
+        """
+        real_filter = TagModel.objects.filter
+
+        def tag_filter(*args, **kwargs):
+            return real_filter(*args, **kwargs).exclude(name=name)
+
+        return mock.patch.object(TagModel.objects, 'filter', side_effect=tag_filter)
+
+    def test_add_tag_created_concurrently(self):
+        """ Adding a tag that gets created by someone else in the meantime returns the existing tag """
+        tax = self.tagstore.create_taxonomy("TestTax", owner_id=some_user)
+        tax.add_tag('shared')
+        with self._hide_tag_from_lookup('shared'):
+            self.assertEqual(tax.add_tag('shared'), Tag(taxonomy_uid=tax.uid, name='shared'))
+        self.assertEqual([t.name for t in tax.list_tags()], ['shared'])
+
+    def test_add_tag_created_concurrently_different_parent(self):
+        """ Adding a tag that gets created by someone else under a different parent tag fails """
+        tax = self.tagstore.create_taxonomy("TestTax", owner_id=some_user)
+        parent = tax.add_tag('parent')
+        tax.add_tag('shared')
+        with self._hide_tag_from_lookup('shared'):
+            with self.assertRaises(ValueError):
+                tax.add_tag('shared', parent_tag=parent)
+        self.assertEqual([t.name for t in tax.list_tags()], ['parent', 'shared'])
@@ -55,7 +55,7 @@ class Taxonomy(TaxonomyPrivate):
         """
         return self.tagstore.list_tags_in_taxonomy(self.uid)
 
-    def list_tags_hierarchically(self) -> Iterator[Tuple[Tag, Tag]]:
+    def list_tags_hierarchically(self) -> Iterator[Tuple[Tag, Optional[Tag]]]:
         """
         Get a list of all tags in the given taxonomy, in hierarchical and alphabetical order.
 
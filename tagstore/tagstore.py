@@ -2,10 +2,14 @@
 A system for storing and retrieving tags related to Blockstore entities
 """
 
-from typing import Iterator, List, Optional, Set, Tuple
+import re
+from typing import FrozenSet, Iterator, List, Optional, Set, Tuple
 
 from .models import EntityId, Tag, TaxonomyId, Taxonomy, UserId
 
+# Characters that are not allowed in tag names
+INVALID_TAG_CHARS = re.compile(r'[:,;\n\r\\]')
+
 
 class Tagstore:
     """
@@ -44,7 +48,7 @@ class Tagstore:
         if name != name.strip():
             raise ValueError("Tag name cannot start or end with whitespace.")
 
-        if any(char in name for char in ':,;\n\r\\'):
+        if INVALID_TAG_CHARS.search(name):
             raise ValueError("Tag name contains an invalid character.")
 
         parent_tag_str = None
@@ -80,7 +84,7 @@ class Tagstore:
         raise NotImplementedError()
         yield None  # Required to make this non-implementation also a generator. pylint: disable=unreachable
 
-    def list_tags_in_taxonomy_hierarchically(self, taxonomy_uid: TaxonomyId) -> Iterator[Tuple[Tag, Tag]]:
+    def list_tags_in_taxonomy_hierarchically(self, taxonomy_uid: TaxonomyId) -> Iterator[Tuple[Tag, Optional[Tag]]]:
         """
         Get a list of all tags in the given taxonomy, in hierarchical and alphabetical order.
 
@@ -148,3 +152,15 @@ class Tagstore:
         """
         raise NotImplementedError()
         yield None  # Required to make this non-implementation also a generator. pylint: disable=unreachable
+
+    def get_entities_with_tags(self, tags: Set[Tag], **kwargs) -> Iterator[Tuple[EntityId, FrozenSet[Tag]]]:
+        """
+        Get an iterator over (entity, tags applied to that entity) for all entities
+        that have all the specified tags.
+
+        Accepts the same filtering keyword arguments as get_entities_tagged_with_all()
+        and is equivalent to calling get_tags_applied_to() on each of its results.
+        """
+        # Backends should override this to avoid querying the tags of each entity separately.
+        for entity_id in self.get_entities_tagged_with_all(tags, **kwargs):
+            yield (entity_id, frozenset(self.get_tags_applied_to(entity_id)))
@@ -67,7 +67,7 @@ class EntityViewSet(viewsets.ViewSet):
         else:
             queryset = entity.tags.all()
 
-        extracted = [self._convert(tag) for tag in queryset]
+        extracted = [self._convert(tag) for tag in queryset.select_related('taxonomy')]
         return EntityTagSerializer({'tags': extracted})
 
     def tags(self, request, entity_type=None, pk=None):